@@ -9,42 +9,101 @@ sys.path.insert(0, str(project_root))
 
 import pandas as pd
 import plotly.express as px
-from utils.optimize import optimize_portfolio
-from utils.risk import risk_contribution
+from utils.optimize import compute_moments, optimize_portfolio
+from utils.risk import risk_contribution, rolling_sharpe
 import numpy as np
 
 st.set_page_config(page_title="Quant Portfolio Dashboard", layout="wide")
 
+STRATEGY_KEYS = ["asset_type", "factor", "mode"]
+
+def index_by_strategy(frame):
+    """Categorical-encode the strategy key columns and use them as a sorted MultiIndex."""
+    frame = frame.astype({k: "category" for k in STRATEGY_KEYS})
+    return frame.set_index(STRATEGY_KEYS).sort_index()
+
 @st.cache_data
 def load_data():
-    results = pd.read_csv("data/portfolio_results_all.csv", parse_dates=["date"])
-    stats = pd.read_csv("data/portfolio_stats_all.csv")
-    asset_returns = pd.read_csv("data/asset_daily_returns.csv", parse_dates=["date"]).set_index("date")
-    holdings = pd.read_csv("data/portfolio_holdings.csv")  # NEW
-    
-    # 🔧 Ensure all values are floats
-    asset_returns = asset_returns.apply(pd.to_numeric, errors="coerce")
+    results = pd.read_parquet("data/portfolio_results_all.parquet")
+    stats = pd.read_parquet("data/portfolio_stats_all.parquet")
+    holdings = pd.read_parquet("data/portfolio_holdings.parquet")  # NEW
+
+    # 🔧 Parquet stores typed float columns (and the date index), so there is no
+    # parsing/coercion pass; downcast to float32 so the cleaning passes in the
+    # optimization tab move half the bytes
+    asset_returns = pd.read_parquet("data/asset_daily_returns.parquet").astype(np.float32)
+
+    # 🔧 Index the strategy tables by their selection keys so filtering is a
+    # sorted-index lookup instead of three full-column equality scans
+    results = index_by_strategy(results)
+    stats = index_by_strategy(stats)
+    holdings = index_by_strategy(holdings)
     return results, stats, asset_returns, holdings
 
+def select_strategy(frame, key):
+    """Return the rows of a strategy-indexed frame for one (asset_type, factor, mode) key."""
+    try:
+        return frame.loc[[key]].reset_index()
+    except KeyError:
+        return frame.iloc[:0].reset_index()
+
+@st.cache_data
+def get_subset(_results, _stats, asset_type, factor, mode):
+    # Leading underscores tell Streamlit not to hash the (static) frames,
+    # so the cache is keyed on the three selections only
+    key = (asset_type, factor, mode)
+    return select_strategy(_results, key), select_strategy(_stats, key)
+
+def clean_returns(arr, lower=-0.50, upper=1.00):
+    """
+    Clean a (days x assets) return matrix in a single NumPy pipeline.
+    Infinities become NaN, gaps are forward- then back-filled per column,
+    anything still missing is zero-filled and values are clipped to [lower, upper].
+    Returns:
+        cleaned: Cleaned matrix (same float dtype as the input)
+        nan_pct: Percentage of NaNs per column in the raw input
+        inf_count: Number of infinities per column in the raw input
+        std: Sample standard deviation per column of the cleaned matrix
+    """
+    n_rows = arr.shape[0]
+    # One finiteness mask drives the fill; NaN counts are derived from it and the
+    # (usually empty) infinity counts instead of building a separate isnan mask
+    valid = np.isfinite(arr)
+    inf_count = np.count_nonzero(np.isinf(arr), axis=0)
+    nan_pct = (n_rows - np.count_nonzero(valid, axis=0) - inf_count) / n_rows * 100
+
+    # Forward/backward fill by propagating the row index of the last/next valid value
+    rows = np.arange(n_rows)[:, None]
+    cols = np.arange(arr.shape[1])
+    ffill_idx = np.maximum.accumulate(np.where(valid, rows, 0), axis=0)
+    bfill_idx = np.minimum.accumulate(np.where(valid, rows, n_rows - 1)[::-1], axis=0)[::-1]
+    has_prev = valid[ffill_idx, cols]
+    cleaned = np.where(has_prev, arr[ffill_idx, cols], arr[bfill_idx, cols])
+    cleaned[~(has_prev | valid[bfill_idx, cols])] = 0.0
+
+    np.clip(cleaned, lower, upper, out=cleaned)
+    std = cleaned.std(axis=0, ddof=1)
+    return cleaned, nan_pct, inf_count, std
+
+@st.cache_resource
+def get_moments(returns):
+    # Expected returns + covariance only depend on the cleaned returns, not the method
+    return compute_moments(returns)
+
+@st.cache_data
+def run_optimization(returns, method):
+    return optimize_portfolio(returns, method=method, moments=get_moments(returns))
+
 results, stats, asset_returns, holdings = load_data()  # Updated
 
 st.sidebar.header("⚙️ Configuration")
-asset_type = st.sidebar.selectbox("Asset Type", sorted(results["asset_type"].unique()))
-factor = st.sidebar.selectbox("Factor", sorted(results["factor"].unique()))
+asset_type = st.sidebar.selectbox("Asset Type", sorted(results.index.unique(level="asset_type")))
+factor = st.sidebar.selectbox("Factor", sorted(results.index.unique(level="factor")))
 mode = st.sidebar.radio("Portfolio Mode", ["long_only", "long_short"])
 tab = st.sidebar.radio("View", ["Performance", "Optimization & Risk"])
+debug = st.sidebar.checkbox("Debug data prep", value=False)
 
-subset = results[
-    (results["asset_type"] == asset_type)
-    & (results["factor"] == factor)
-    & (results["mode"] == mode)
-]
-
-subset_stats = stats[
-    (stats["asset_type"] == asset_type)
-    & (stats["factor"] == factor)
-    & (stats["mode"] == mode)
-]
+subset, subset_stats = get_subset(results, stats, asset_type, factor, mode)
 
 if subset.empty:
     st.warning("⚠️ No data for this configuration.")
@@ -67,7 +126,7 @@ if tab == "Performance":
     st.plotly_chart(fig, use_container_width=True)
     
     st.subheader("Rolling 60-Day Sharpe Ratio")
-    subset["rolling_sharpe"] = subset["portfolio_return"].rolling(60).mean() / subset["portfolio_return"].rolling(60).std()
+    subset["rolling_sharpe"] = rolling_sharpe(subset["portfolio_return"].to_numpy(), 60)
     fig2 = px.line(subset, x="date", y="rolling_sharpe", title="Rolling 60-Day Sharpe")
     fig2.update_layout(template="plotly_dark", height=300)
     st.plotly_chart(fig2, use_container_width=True)
@@ -85,11 +144,7 @@ else:
     st.subheader("🔍 Data Preparation")
     
     # === GET FACTOR-SPECIFIC TICKERS FROM HOLDINGS FILE ===
-    holdings_subset = holdings[
-        (holdings["asset_type"] == asset_type) &
-        (holdings["factor"] == factor) &
-        (holdings["mode"] == mode)
-    ]
+    holdings_subset = select_strategy(holdings, (asset_type, factor, mode))
     
     if holdings_subset.empty:
         st.error(f"❌ No holdings found for {asset_type} - {factor} - {mode}")
@@ -111,41 +166,39 @@ else:
         st.warning(f"⚠️ Only {len(available_tickers)} factor-selected assets have sufficient return data.")
         st.info(f"Expanding to all {asset_type} assets as fallback...")
         
-        # Fallback to all assets in asset class
-        def get_asset_type_from_ticker(ticker):
-            if '-USD' in ticker:
-                return 'Crypto'
-            else:
-                return 'Equity'
-        
-        available_tickers = [col for col in asset_returns.columns 
-                            if get_asset_type_from_ticker(col) == asset_type]
+        # Fallback to all assets in asset class (crypto tickers are quoted as *-USD)
+        is_crypto = asset_returns.columns.str.contains("-USD", regex=False)
+        asset_mask = is_crypto if asset_type == "Crypto" else ~is_crypto
+        available_tickers = asset_returns.columns[asset_mask].tolist()
         
         if len(available_tickers) < 2:
             st.error(f"❌ Only {len(available_tickers)} {asset_type} assets available")
             st.stop()
     
-    pivot = asset_returns[available_tickers].copy()
+    # No defensive copy: clean_returns() never mutates its input
+    pivot = asset_returns[available_tickers]
     pivot = pivot.select_dtypes(include=["number"])
     
-    # Calculate NaN percentages
-    nan_pct = (pivot.isna().sum() / len(pivot) * 100).round(2)
+    # Clean every candidate column in one pass; the per-column stats drive the filters below
+    cleaned, nan_pct, inf_counts, stds = clean_returns(pivot.to_numpy())
+    nan_pct = pd.Series(nan_pct, index=pivot.columns).round(2)
     
-    st.write("**Top 10 assets by data quality:**")
-    st.dataframe(nan_pct.sort_values().head(10).to_frame('NaN %'))
+    if debug:
+        st.write("**Top 10 assets by data quality:**")
+        st.dataframe(nan_pct.sort_values().head(10).to_frame('NaN %'))
     
     # === DYNAMIC THRESHOLD BASED ON ASSET TYPE ===
-    if asset_type == 'Equity':
-        threshold = 80
-        st.info("ℹ️ Using 80% NaN threshold for Equity")
-    else:
-        threshold = 50
-        st.info("ℹ️ Using 50% NaN threshold for Crypto")
+    threshold = 80 if asset_type == 'Equity' else 50
+    if debug:
+        st.info(f"ℹ️ Using {threshold}% NaN threshold for {asset_type}")
     
-    pivot_clean = pivot.loc[:, nan_pct < threshold]
+    keep = (nan_pct < threshold).to_numpy()
+    pivot_clean = pd.DataFrame(cleaned[:, keep], index=pivot.index, columns=pivot.columns[keep])
+    stds = pd.Series(stds[keep], index=pivot_clean.columns)
     
-    st.write(f"\n**Assets with <{threshold}% NaNs:** {list(pivot_clean.columns)}")
-    st.write(f"**Shape:** {pivot_clean.shape}")
+    if debug:
+        st.write(f"\n**Assets with <{threshold}% NaNs:** {list(pivot_clean.columns)}")
+        st.write(f"**Shape:** {pivot_clean.shape}")
     
     if pivot_clean.shape[1] < 2:
         st.error(f"❌ Only {pivot_clean.shape[1]} assets available with <{threshold}% NaNs")
@@ -157,36 +210,31 @@ else:
             st.write(f"- <{thresh}% NaNs: {count} assets")
         st.stop()
     
-    # Check for infinities
-    inf_count_before = np.isinf(pivot_clean).sum().sum()
-    if inf_count_before > 0:
+    # Infinities were replaced with NaN and filled along with the gaps
+    inf_count_before = inf_counts[keep].sum()
+    if debug and inf_count_before > 0:
         st.write(f"**Infinity values found:** {inf_count_before}")
     
-    # Replace infinities with NaN, then fill
-    pivot_clean = pivot_clean.replace([np.inf, -np.inf], np.nan)
-    
-    # Fill NaNs
-    pivot_clean = pivot_clean.fillna(method='ffill').fillna(method='bfill').fillna(0)
-    
-    # Clip extreme values
-    pivot_clean = pivot_clean.clip(lower=-0.50, upper=1.00)
-    st.write(f"**After clipping to [-50%, +100%]:** Max={pivot_clean.max().max():.4f}, Min={pivot_clean.min().min():.4f}")
+    if debug:
+        st.write(f"**After clipping to [-50%, +100%]:** Max={pivot_clean.max().max():.4f}, Min={pivot_clean.min().min():.4f}")
     
     # Drop zero variance
-    pivot_clean = pivot_clean.loc[:, pivot_clean.std() > 1e-6]
-    st.write(f"**After dropping zero variance:** {pivot_clean.shape}")
+    pivot_clean = pivot_clean.loc[:, stds > 1e-6]
+    if debug:
+        st.write(f"**After dropping zero variance:** {pivot_clean.shape}")
     
-    # Final check
-    final_nans = pivot_clean.isna().sum().sum()
-    final_infs = np.isinf(pivot_clean).sum().sum()
+    # Final check (a single finiteness scan; the detailed breakdown is debug-only)
+    values = pivot_clean.to_numpy()
+    all_finite = np.isfinite(values).all()
     
-    st.write(f"\n**Final data quality:**")
-    st.write(f"  - NaNs: {final_nans}")
-    st.write(f"  - Infinities: {final_infs}")
-    st.write(f"  - Min value: {pivot_clean.min().min():.4f}")
-    st.write(f"  - Max value: {pivot_clean.max().max():.4f}")
+    if debug:
+        st.write(f"\n**Final data quality:**")
+        st.write(f"  - NaNs: {np.isnan(values).sum()}")
+        st.write(f"  - Infinities: {np.isinf(values).sum()}")
+        st.write(f"  - Min value: {values.min():.4f}")
+        st.write(f"  - Max value: {values.max():.4f}")
     
-    if final_nans > 0 or final_infs > 0:
+    if not all_finite:
         st.error("❌ Data still contains NaNs or infinities after cleaning")
         st.stop()
     
@@ -198,7 +246,8 @@ else:
     
     # Run optimization
     try:
-        weights, perf, mu, S = optimize_portfolio(pivot_clean, method=opt_method)
+        # Returns are stored as float32; the solvers get float64 moments
+        weights, perf, mu, S = run_optimization(pivot_clean.astype(np.float64), opt_method)
         
         w_series = pd.Series(weights)
         
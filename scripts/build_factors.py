@@ -2,6 +2,8 @@
 
 import pandas as pd
 import duckdb
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor
 from utils.factors import (
     compute_returns,
     momentum_factor,
@@ -12,40 +14,51 @@ from utils.factors import (
     combine_factors,
 )
 
-# === Load data ===
-eq = pd.read_csv("data/raw_equities.csv", parse_dates=["date"])
-cr = pd.read_csv("data/raw_crypto.csv", parse_dates=["date"])
-
-# Standardize column names
-#eq.rename(columns={"Ticker": "ticker", "Close": "close"}, inplace=True)
-#cr.rename(columns={"Ticker": "ticker", "Close": "close"}, inplace=True)
-
-# Add returns and compute factors
-eq = compute_returns(eq)
-eq = momentum_factor(eq)
-eq = volatility_factor(eq)
-eq = value_factor(eq)
-eq = quality_factor(eq)
-
-cr = compute_returns(cr)
-cr = momentum_factor(cr)
-cr = volatility_factor(cr)
-cr = quality_factor(cr)  # crypto may not have value
-
-# Standardize
 factor_cols_eq = ["momentum", "volatility", "value", "quality"]
 factor_cols_cr = ["momentum", "volatility", "quality"]
 
-eq = standardize_factors(eq, factor_cols_eq)
-cr = standardize_factors(cr, factor_cols_cr)
 
-# Combine
-eq = combine_factors(eq, factor_cols_eq)
-cr = combine_factors(cr, factor_cols_cr)
+def build_equities() -> pd.DataFrame:
+    """Load raw equity prices and compute standardized factor scores."""
+    return (
+        pd.read_csv("data/raw_equities.csv", parse_dates=["date"])
+        .sort_values(["ticker", "date"], ignore_index=True)  # the only sort; factor functions rely on it
+        .pipe(compute_returns)
+        .pipe(momentum_factor)
+        .pipe(volatility_factor)
+        .pipe(value_factor)
+        .pipe(quality_factor)
+        .pipe(standardize_factors, factor_cols_eq)
+        .pipe(combine_factors, factor_cols_eq)
+        .assign(asset_type="Equity")
+    )
+
+
+def build_crypto() -> pd.DataFrame:
+    """Load raw crypto prices and compute standardized factor scores."""
+    return (
+        pd.read_csv("data/raw_crypto.csv", parse_dates=["date"])
+        .sort_values(["ticker", "date"], ignore_index=True)  # the only sort; factor functions rely on it
+        .pipe(compute_returns)
+        .pipe(momentum_factor)
+        .pipe(volatility_factor)
+        .pipe(quality_factor)  # crypto may not have value
+        .pipe(standardize_factors, factor_cols_cr)
+        .pipe(combine_factors, factor_cols_cr)
+        .assign(asset_type="Crypto")
+    )
+
+
+# Standardize column names
+#eq.rename(columns={"Ticker": "ticker", "Close": "close"}, inplace=True)
+#cr.rename(columns={"Ticker": "ticker", "Close": "close"}, inplace=True)
 
-# Add labels
-eq["asset_type"] = "Equity"
-cr["asset_type"] = "Crypto"
+# === Build both asset classes concurrently (pandas/NumPy kernels release the GIL) ===
+with ThreadPoolExecutor(max_workers=2) as pool:
+    eq_future = pool.submit(build_equities)
+    cr_future = pool.submit(build_crypto)
+    eq = eq_future.result()
+    cr = cr_future.result()
 
 # Before saving
 #eq = eq.drop(columns=["return"], errors="ignore")
@@ -62,18 +75,21 @@ cr.to_csv("data/factors_crypto.csv", index=False)
 # === Optional: Store in DuckDB and create combined view ===
 con = duckdb.connect("data/factors.duckdb")
 
-con.execute("CREATE OR REPLACE TABLE factors_equities AS SELECT * FROM eq")
-con.execute("CREATE OR REPLACE TABLE factors_crypto AS SELECT * FROM cr")
+# Register explicitly as Arrow tables rather than relying on the implicit DataFrame scan
+con.register("eq_view", pa.Table.from_pandas(eq, preserve_index=False))
+con.register("cr_view", pa.Table.from_pandas(cr, preserve_index=False))
+con.execute("CREATE OR REPLACE TABLE factors_equities AS SELECT * FROM eq_view")
+con.execute("CREATE OR REPLACE TABLE factors_crypto AS SELECT * FROM cr_view")
+con.unregister("eq_view")
+con.unregister("cr_view")
 
-# Align columns for union (missing ones replaced with NULL)
-common_cols = set(eq.columns) & set(cr.columns)
-query = f"""
+# Union by column name (columns missing from one side, e.g. crypto value, become NULL)
+con.execute("""
 CREATE OR REPLACE VIEW factors_all AS
-SELECT {', '.join(common_cols)} FROM factors_equities
-UNION ALL
-SELECT {', '.join(common_cols)} FROM factors_crypto;
-"""
-con.execute(query)
+SELECT * FROM factors_equities
+UNION ALL BY NAME
+SELECT * FROM factors_crypto;
+""")
 
 print(con.execute("SELECT asset_type, COUNT(*) FROM factors_all GROUP BY 1;").fetchdf())
 con.close()
@@ -1,119 +1,255 @@
 # scripts/run_backtest.py
 import pandas as pd
-from utils.backtest import form_portfolios, compute_performance
+import numpy as np
+from utils.backtest import (
+    form_portfolios,
+    compute_performance,
+    rank_scores,
+    backtest_duckdb,
+    performance_stats,
+    asset_return_matrix,
+)
 import os
+import argparse
 import duckdb
+import pyarrow as pa
+from joblib import Parallel, delayed
 
 DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
+parser = argparse.ArgumentParser(description="Run factor portfolio backtests.")
+parser.add_argument("--csv", action="store_true", help="also write the legacy CSV outputs")
+parser.add_argument("--engine", choices=["pandas", "duckdb"], default="pandas",
+                    help="duckdb runs every strategy in a single SQL query")
+args = parser.parse_args()
+
 # === Load prepared factor data ===
 df_eq = pd.read_csv(os.path.join(DATA_DIR, "factors_equities.csv"), parse_dates=["date"])
 df_cr = pd.read_csv(os.path.join(DATA_DIR, "factors_crypto.csv"), parse_dates=["date"])
-df = pd.concat([df_eq, df_cr], ignore_index=True)
-df.columns = df.columns.str.lower()
+df_eq.columns = df_eq.columns.str.lower()
+df_cr.columns = df_cr.columns.str.lower()
+
+# Prices, returns and factor scores are only meaningful to ~6 digits: float32 halves
+# the bytes every rank/pivot pass moves (portfolio returns are summed in float64)
+for frame in (df_eq, df_cr):
+    float_cols = frame.select_dtypes(np.float64).columns
+    frame[float_cols] = frame[float_cols].astype(np.float32)
 
 # === Configuration ===
 factors = ["momentum", "value", "quality", "multi_factor_score"]
 asset_types = ["Equity", "Crypto"]
 modes = ["long_short", "long_only"]
+quantiles = {"Equity": 0.2, "Crypto": 0.4}  # more inclusive for small universes
+
+
+def _run(asset, factor, mode, subset, ranks):
+    """
+    Backtest a single (asset, factor, mode) strategy on its asset-class partition.
+    `ranks` holds just this factor's rank_scores() columns, so a worker only receives what it uses.
+    Returns (perf, stats, asset_returns, holdings_record), or None if nothing was formed.
+    perf and asset_returns are date-indexed numeric frames.
+    """
+    print(f"\n▶️ Running {asset} — {factor} — {mode}")
+    if subset.empty:
+        return None
+    if factor not in subset.columns:  # e.g. crypto has no value factor
+        print(f"⚠️ No results for {asset} — {factor} — {mode}")
+        return None
+    
+    print(subset[['date','ticker',factor,'return']].tail())
+    # Row count of the usable data without materialising a dropna() copy per strategy
+    print((int(subset[[factor, 'return']].notna().all(axis=1).sum()), subset.shape[1]))
+    
+    # --- Portfolio formation now returns both portfolio & per-asset returns ---
+    portfolios, asset_returns = form_portfolios(
+        subset,
+        quantile=quantiles[asset],
+        long_short=(mode == "long_short"),
+        group_col="asset_type",
+        score_col=factor,
+        ranks=ranks,
+    )
+    
+    perf, stats = compute_performance(portfolios)
+    
+    if perf.empty:
+        print(f"⚠️ No results for {asset} — {factor} — {mode}")
+        return None
+    
+    # Metadata is tagged once on the stacked results, not per strategy frame
+    perf = perf.set_index("date")
+    
+    # NEW: Save which tickers were selected by this strategy
+    holdings_record = None
+    if not portfolios.empty:
+        holdings_record = _holdings_record(asset, factor, mode, portfolios['ticker'].unique())
+    
+    return perf, stats, asset_returns, holdings_record
+
+
+def _holdings_record(asset, factor, mode, tickers):
+    """Which tickers a strategy ever held, as one row of portfolio_holdings."""
+    tickers_used = sorted(tickers)
+    print(f"   ✓ Selected {len(tickers_used)} tickers: {', '.join(tickers_used[:5])}{'...' if len(tickers_used) > 5 else ''}")
+    return {
+        'asset_type': asset,
+        'factor': factor,
+        'mode': mode,
+        'tickers': ','.join(tickers_used),  # Comma-separated string
+        'num_tickers': len(tickers_used)
+    }
+
+
+def _run_sql(combos, frames):
+    """
+    Backtest every strategy in one DuckDB query (see backtest_duckdb).
+    Returns one _run-style result tuple (or None) per combo, in the same order.
+    """
+    holdings, perf = backtest_duckdb(frames, factors, quantiles, modes)
+    
+    strategy = ["asset_type", "factor", "mode"]
+    perf_by_strategy = dict(tuple(perf.groupby(strategy, sort=False, observed=True)))
+    tickers_by_strategy = holdings.groupby(strategy, sort=False, observed=True)["ticker"].unique()
+    pivots = {asset: asset_return_matrix(frame) for asset, frame in frames.items()}
+    
+    results = []
+    for asset, factor, mode in combos:
+        key = (asset, factor, mode)
+        if key not in perf_by_strategy:
+            print(f"⚠️ No results for {asset} — {factor} — {mode}")
+            results.append(None)
+            continue
+        print(f"\n▶️ {asset} — {factor} — {mode}")
+        strat_perf = perf_by_strategy[key].set_index("date")[["portfolio_return", "cumulative"]]
+        stats = performance_stats(strat_perf["portfolio_return"], strat_perf["cumulative"])
+        tickers = tickers_by_strategy[key]
+        pivot = pivots[asset]
+        asset_returns = pivot[[col for col in pivot.columns if col in tickers]]
+        results.append((strat_perf, stats, asset_returns, _holdings_record(asset, factor, mode, tickers)))
+    return results
+
+
+def _stack(frames):
+    """
+    Stack date-indexed numeric frames into one preallocated float block (dtype kept, e.g. float32).
+    Columns are outer-joined in order of first appearance (NaN where a frame lacks one).
+    """
+    columns = pd.Index(list(dict.fromkeys(c for frame in frames for c in frame.columns)))
+    dtype = np.result_type(np.float32, *(dt for frame in frames for dt in frame.dtypes))
+    offsets = np.cumsum([0] + [len(frame) for frame in frames])
+    values = np.full((offsets[-1], len(columns)), np.nan, dtype=dtype)
+    for frame, start, stop in zip(frames, offsets[:-1], offsets[1:]):
+        values[start:stop, columns.get_indexer(frame.columns)] = frame.to_numpy(dtype=dtype)
+    index = pd.Index(np.concatenate([frame.index.to_numpy() for frame in frames]), name="date")
+    return pd.DataFrame(values, index=index, columns=columns)
+
+
+def _tag_strategies(stacked, keys, frames):
+    """Add asset_type/factor/mode columns, repeating each strategy's key over its block of rows."""
+    lengths = [len(frame) for frame in frames]
+    for i, name in enumerate(["asset_type", "factor", "mode"]):
+        stacked[name] = np.repeat([key[i] for key in keys], lengths)
+    return stacked
+
+
+# === Run backtests ===
+# Every (asset, factor, mode) combination is independent, so fan them out across cores
+combos = [(asset, factor, mode) for asset in asset_types for factor in factors for mode in modes]
+# Each asset class is already its own frame — no need to concat and re-filter
+partitions = {"Equity": df_eq, "Crypto": df_cr}
+if args.engine == "duckdb":
+    results = _run_sql(combos, partitions)
+else:
+    # Rank all factors in one pass per asset class; every strategy reuses these
+    ranks = {
+        asset: rank_scores(frame, [f for f in factors if f in frame.columns], group_col="asset_type")
+        for asset, frame in partitions.items()
+    }
+    # Ship each worker only its partition and its factor's ranks (empty if the factor is absent)
+    results = Parallel(n_jobs=-1, backend="loky")(
+        delayed(_run)(asset, factor, mode, partitions[asset], ranks[asset].reindex(columns=[factor], level=0))
+        for asset, factor, mode in combos
+    )
 
 # === Results containers ===
+all_keys = []
 all_perf = []
 all_stats = []
 all_asset_returns = []
 all_holdings = []  # NEW: Track portfolio holdings
 
-# === Run backtests ===
-for asset in asset_types:
-    for factor in factors:
-        for mode in modes:
-            print(f"\n▶️ Running {asset} — {factor} — {mode}")
-            subset = df[df["asset_type"] == asset].copy()
-            if subset.empty:
-                continue
-            
-            subset["multi_factor_score"] = subset[factor]
-            print(subset[['date','ticker','multi_factor_score','return']].tail())
-            print(subset.dropna(subset=['multi_factor_score','return']).shape)
-            
-            quant = 0.2 if asset == "Equity" else 0.4  # more inclusive for small universes
-            
-            # --- Portfolio formation now returns both portfolio & per-asset returns ---
-            portfolios, asset_returns = form_portfolios(
-                subset,
-                quantile=quant,
-                long_short=(mode == "long_short"),
-                group_col="asset_type",
-            )
-            
-            perf, stats = compute_performance(portfolios)
-            
-            if perf.empty:
-                print(f"⚠️ No results for {asset} — {factor} — {mode}")
-                continue
-            
-            # Tag metadata
-            perf["asset_type"] = asset
-            perf["factor"] = factor
-            perf["mode"] = mode
-            
-            stats["asset_type"] = asset
-            stats["factor"] = factor
-            stats["mode"] = mode
-            
-            asset_returns["asset_type"] = asset
-            asset_returns["factor"] = factor
-            asset_returns["mode"] = mode
-            
-            # NEW: Save which tickers were selected by this strategy
-            if not portfolios.empty:
-                tickers_used = sorted(portfolios['ticker'].unique())
-                holdings_record = {
-                    'asset_type': asset,
-                    'factor': factor,
-                    'mode': mode,
-                    'tickers': ','.join(tickers_used),  # Comma-separated string
-                    'num_tickers': len(tickers_used)
-                }
-                all_holdings.append(holdings_record)
-                print(f"   ✓ Selected {len(tickers_used)} tickers: {', '.join(tickers_used[:5])}{'...' if len(tickers_used) > 5 else ''}")
-            
-            all_perf.append(perf)
-            all_stats.append(stats)
-            all_asset_returns.append(asset_returns)
+for key, result in zip(combos, results):
+    if result is None:
+        continue
+    perf, stats, asset_returns, holdings_record = result
+    if holdings_record is not None:
+        all_holdings.append(holdings_record)
+    all_keys.append(key)
+    all_perf.append(perf)
+    all_stats.append({**stats, "asset_type": key[0], "factor": key[1], "mode": key[2]})
+    all_asset_returns.append(asset_returns)
 
 # === Combine & Save Results ===
-perf_df = pd.concat(all_perf, ignore_index=True)
+# One allocation per output instead of incremental pd.concat of the per-strategy frames
+perf_df = _tag_strategies(_stack(all_perf), all_keys, all_perf).reset_index()
 stats_df = pd.DataFrame(all_stats)
 holdings_df = pd.DataFrame(all_holdings)  # NEW
 
-# For asset returns, concatenate but DON'T keep the metadata columns in the CSV
-asset_ret_df = pd.concat(all_asset_returns, ignore_index=False)
-
-# Remove metadata columns before saving to CSV
-asset_ret_csv = asset_ret_df.drop(columns=['asset_type', 'factor', 'mode'], errors='ignore')
-
-perf_df.to_csv(f"{DATA_DIR}/portfolio_results_all.csv", index=False)
-stats_df.to_csv(f"{DATA_DIR}/portfolio_stats_all.csv", index=False)
-asset_ret_csv.to_csv(f"{DATA_DIR}/asset_daily_returns.csv")
-holdings_df.to_csv(f"{DATA_DIR}/portfolio_holdings.csv", index=False)  # NEW
-
-print("\n✅ All results saved to:")
-print(" - data/portfolio_results_all.csv")
-print(" - data/portfolio_stats_all.csv")
-print(" - data/asset_daily_returns.csv")
-print(" - data/portfolio_holdings.csv")  # NEW
+# Asset returns are saved to disk WITHOUT the metadata columns;
+# the DuckDB copy gets them on a shallow copy (no data duplication)
+asset_ret_out = _stack(all_asset_returns)
+asset_ret_df = _tag_strategies(asset_ret_out.copy(deep=False), all_keys, all_asset_returns)
 
 # === Store to DuckDB ===
+# Register each frame explicitly as an Arrow table and build the table from the
+# registered view, so DuckDB scans columnar buffers instead of pandas objects
+tables = {
+    "portfolio_results": pa.Table.from_pandas(perf_df, preserve_index=False),
+    "portfolio_stats": pa.Table.from_pandas(stats_df, preserve_index=False),
+    "portfolio_holdings": pa.Table.from_pandas(holdings_df, preserve_index=False),  # NEW
+    # Keep metadata in DuckDB version if you want (date index kept as a column)
+    "asset_daily_returns": pa.Table.from_pandas(asset_ret_df, preserve_index=True),
+}
 con = duckdb.connect("data/backtest_results.duckdb")
-con.execute("CREATE OR REPLACE TABLE portfolio_results AS SELECT * FROM perf_df")
-con.execute("CREATE OR REPLACE TABLE portfolio_stats AS SELECT * FROM stats_df")
-con.execute("CREATE OR REPLACE TABLE portfolio_holdings AS SELECT * FROM holdings_df")  # NEW
-# Keep metadata in DuckDB version if you want
-con.execute("CREATE OR REPLACE TABLE asset_daily_returns AS SELECT * FROM asset_ret_df")
+for name, frame in tables.items():
+    con.register(f"{name}_view", frame)
+    con.execute(f"CREATE OR REPLACE TABLE {name} AS SELECT * FROM {name}_view")
+    con.unregister(f"{name}_view")
+
+# === Save files ===
+# Parquet keeps dtypes and is far cheaper to write/read than CSV; CSV only with --csv.
+# The plain tables are written by DuckDB straight from the tables just built, so each
+# frame is converted once; asset returns go through pandas to keep their date index.
+outputs = [
+    (perf_df, "portfolio_results_all", "portfolio_results"),
+    (stats_df, "portfolio_stats_all", "portfolio_stats"),
+    (asset_ret_out, "asset_daily_returns", None),  # keep the date index
+    (holdings_df, "portfolio_holdings", "portfolio_holdings"),  # NEW
+]
+for frame, name, table in outputs:
+    if table:
+        con.execute(f"COPY {table} TO '{DATA_DIR}/{name}.parquet' (FORMAT PARQUET, COMPRESSION ZSTD)")
+    else:
+        frame.to_parquet(f"{DATA_DIR}/{name}.parquet", engine="pyarrow", compression="zstd", index=True)
+
+# Legacy CSVs go through DuckDB's parallel CSV writer; dates are cast back to plain
+# YYYY-MM-DD (and kept as the first column) to match what to_csv used to write
+if args.csv:
+    con.register("asset_daily_returns_disk", pa.Table.from_pandas(asset_ret_out, preserve_index=True))
+    for frame, name, table in outputs:
+        has_date = "date" in frame.columns or frame.index.name == "date"
+        columns = "CAST(date AS DATE) AS date, * EXCLUDE (date)" if has_date else "*"
+        con.execute(
+            f"COPY (SELECT {columns} FROM {table or 'asset_daily_returns_disk'}) "
+            f"TO '{DATA_DIR}/{name}.csv' (FORMAT CSV, HEADER)"
+        )
+    con.unregister("asset_daily_returns_disk")
 con.close()
 
+print("\n✅ All results saved to:")
+for _, name, _ in outputs:
+    print(f" - data/{name}.parquet" + (" (+ .csv)" if args.csv else ""))
 print("✅ Saved results to DuckDB: data/backtest_results.duckdb")
 
 # Print summary
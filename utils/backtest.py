@@ -1,80 +1,137 @@
 # utils/backtest.py
 import pandas as pd
 import numpy as np
+import duckdb
+import pyarrow as pa
+
+def _rank_within_groups(codes: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """
+    1-based rank of each row by ascending `keys` within its group code.
+    lexsort is stable, so ties keep row order (same as rank(method='first')).
+    """
+    order = np.lexsort((keys, codes))
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    ranks = np.empty(len(order))
+    ranks[order] = np.arange(len(order)) - np.repeat(starts, sizes) + 1
+    return ranks
+
+
+def rank_scores(df: pd.DataFrame, score_cols, group_col: str | None = None, bottom: bool = True):
+    """
+    Rank every score column within each (group, date) cross-section.
+    Rows with a missing score or return get no rank and are not counted.
+    Returns a frame aligned to df with columns (score_col, "top" | "bottom" | "n");
+    bottom=False skips the ascending (short-side) ranking when only long legs are needed.
+    """
+    keys = [group_col, "date"] if group_col else ["date"]
+    groups = df.groupby(keys, sort=False, observed=True)
+    codes = groups.ngroup().to_numpy()
+    has_return = df["return"].notna().to_numpy()
+    
+    ranks = {}
+    for col in score_cols:
+        score = df[col].to_numpy()  # float32 scores rank as-is
+        valid = has_return & ~np.isnan(score)
+        ranks[(col, "top")] = np.full(len(df), np.nan)
+        ranks[(col, "top")][valid] = _rank_within_groups(codes[valid], -score[valid])  # same tie order as nlargest
+        if bottom:
+            ranks[(col, "bottom")] = np.full(len(df), np.nan)
+            ranks[(col, "bottom")][valid] = _rank_within_groups(codes[valid], score[valid])  # as nsmallest
+        ranks[(col, "n")] = np.bincount(codes[valid], minlength=groups.ngroups)[codes]
+    return pd.DataFrame(ranks, index=df.index)
+
+
+def asset_return_matrix(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Date x ticker matrix of daily returns.
+    (date, ticker) is unique in the factor files, so a plain unstack replaces pivot_table;
+    dropping missing returns first keeps its first-non-null / all-NaN-row rules.
+    """
+    returns = df.loc[df["return"].notna(), ["date", "ticker", "return"]]
+    if returns.duplicated(["date", "ticker"]).any():
+        returns = returns.drop_duplicates(["date", "ticker"], keep="first")
+    return returns.set_index(["date", "ticker"])["return"].unstack("ticker").sort_index()
+
 
 def form_portfolios(
     df: pd.DataFrame,
     quantile: float = 0.2,
     long_short: bool = True,
     group_col: str | None = None,
+    score_col: str = "multi_factor_score",
+    ranks: pd.DataFrame | None = None,
 ):
     """
     Form long/short portfolios based on factor scores.
+    Assets are ranked on `score_col` (any factor column can be passed directly).
+    `ranks` can be precomputed with rank_scores() to share one ranking pass across strategies.
+    Expects lower-case column names (normalise once at load time); df is not modified.
     Returns:
         portfolios_df: Portfolio holdings with positions
         asset_daily_returns: Complete return history for ALL assets in universe
     """
-    df.columns = df.columns.str.lower()
-    portfolios = []
+    if ranks is None:
+        ranks = rank_scores(df, [score_col], group_col, bottom=long_short)
+    ranks = ranks[score_col]
     
     # === BUILD PORTFOLIO HOLDINGS ===
-    group_iter = df.groupby([group_col, "date"]) if group_col else df.groupby("date")
+    n = ranks["n"]
+    cutoff = np.maximum(1, (n * quantile).astype(int))
+    formed = n >= 5  # skip tiny groups
+    if long_short:
+        formed &= cutoff * 2 <= n
     
-    for keys, group in group_iter:
-        group = group.dropna(subset=["multi_factor_score", "return"])
-        n = len(group)
-        
-        if n < 5:  # skip tiny groups
-            continue
-        
-        cutoff = max(1, int(n * quantile))
-        
-        if long_short:
-            if cutoff * 2 > n:
-                continue
-            long = group.nlargest(cutoff, "multi_factor_score").copy()
-            short = group.nsmallest(cutoff, "multi_factor_score").copy()
-            long["position"] = 1 / len(long)
-            short["position"] = -1 / len(short)
-            combined = pd.concat([long, short])
-        else:
-            long = group.nlargest(cutoff, "multi_factor_score").copy()
-            long["position"] = 1 / len(long)
-            combined = long
-        
-        combined["weighted_return"] = combined["return"] * combined["position"]
-        
-        if group_col:
-            combined[group_col] = group[group_col].iloc[0]
-        combined["date"] = group["date"].iloc[0]
-        
-        portfolios.append(combined)
+    long_mask = formed & (ranks["top"] <= cutoff)
+    if long_short:
+        short_mask = formed & (ranks["bottom"] <= cutoff)
+    else:
+        short_mask = pd.Series(False, index=long_mask.index)
+    position = np.where(long_mask, 1 / cutoff, 0.0) + np.where(short_mask, -1 / cutoff, 0.0)
     
-    if not portfolios:
+    selected = long_mask | short_mask
+    if not selected.any():
         print("⚠️ Warning: No portfolio data formed.")
         return pd.DataFrame(), pd.DataFrame()
     
-    portfolios_df = pd.concat(portfolios, ignore_index=True)
+    # One filter over the whole frame — no per-leg frames to concat
+    keys = [group_col, "date"] if group_col else ["date"]
+    selected = selected.to_numpy()
+    position = position[selected]
+    portfolios_df = (
+        df.loc[selected]
+        .assign(position=position, weighted_return=df["return"].to_numpy()[selected] * position)
+        .sort_values(keys, kind="stable")
+        .reset_index(drop=True)
+    )
     
     # === BUILD COMPLETE ASSET RETURNS (FIX IS HERE) ===
     # Instead of using portfolios_df, use the ORIGINAL df to get ALL asset returns
-    asset_daily_returns = df.pivot_table(
-        index="date", 
-        columns="ticker", 
-        values="return", 
-        aggfunc="first"  # Use first instead of mean to avoid duplicates
-    ).sort_index()
+    asset_daily_returns = asset_return_matrix(df)
     
     # Only keep tickers that appeared in at least one portfolio
     # (optional - you can remove this to keep ALL tickers)
-    portfolio_tickers = portfolios_df['ticker'].unique()
-    asset_daily_returns = asset_daily_returns[
-        [col for col in asset_daily_returns.columns if col in portfolio_tickers]
-    ]
+    portfolio_tickers = set(portfolios_df['ticker'].unique())
+    asset_daily_returns = asset_daily_returns.reindex(
+        columns=[col for col in asset_daily_returns.columns if col in portfolio_tickers]
+    )
     
     return portfolios_df, asset_daily_returns
 
 
+def compound_returns(r: np.ndarray) -> np.ndarray:
+    """
+    Cumulative growth of a daily return series.
+    Compounds in log space (vectorised cumsum); a -100% or worse day has no log,
+    so it falls back to the plain product then.
+    """
+    r = np.asarray(r, dtype=np.float64)
+    if (r > -1).all():
+        return np.exp(np.cumsum(np.log1p(r)))
+    return np.cumprod(1 + r)
+
+
 def compute_performance(portfolios: pd.DataFrame):
     """
     Compute portfolio performance metrics.
@@ -90,22 +147,104 @@ def compute_performance(portfolios: pd.DataFrame):
         }
         return empty_perf, empty_stats
 
-    daily_returns = portfolios.groupby("date")["weighted_return"].sum()
-    cumulative = (1 + daily_returns).cumprod()
+    # form_portfolios already emits rows in date order, so only sort if a caller didn't
+    daily = portfolios.groupby("date", sort=False, observed=True, as_index=False)["weighted_return"].sum()
+    if not daily["date"].is_monotonic_increasing:
+        daily = daily.sort_values("date", ignore_index=True)
+    r = np.ascontiguousarray(daily["weighted_return"].to_numpy(dtype=np.float64))
+    cumulative = compound_returns(r)
 
-    stats = {
-        "Cumulative Return": cumulative.iloc[-1] - 1,
-        "Sharpe Ratio": daily_returns.mean() / daily_returns.std() * np.sqrt(252)
-        if daily_returns.std() > 0
-        else 0,
-        "Volatility": daily_returns.std() * np.sqrt(252),
-        "Max Drawdown": (cumulative / cumulative.cummax() - 1).min(),
-    }
+    stats = performance_stats(r, cumulative)
 
     perf = pd.DataFrame({
-        "date": daily_returns.index,
-        "portfolio_return": daily_returns.values,
-        "cumulative": cumulative.values
+        "date": daily["date"].to_numpy(),
+        "portfolio_return": r,
+        "cumulative": cumulative
     })
 
     return perf, stats
+
+
+def performance_stats(daily_returns, cumulative):
+    """
+    Summary stats from daily returns and their cumulative growth (Series or arrays).
+    Works on the raw arrays: one mean, one std and one running-max scan.
+    """
+    r = np.asarray(daily_returns, dtype=np.float64)
+    cum = np.asarray(cumulative, dtype=np.float64)
+    std = r.std(ddof=1) if len(r) > 1 else np.nan
+    return {
+        "Cumulative Return": cum[-1] - 1,
+        "Sharpe Ratio": r.mean() / std * np.sqrt(252) if std > 0 else 0,
+        "Volatility": std * np.sqrt(252),
+        "Max Drawdown": (cum / np.maximum.accumulate(cum) - 1).min(),
+    }
+
+
+def backtest_duckdb(frames: dict, factors, quantiles: dict, modes=("long_short", "long_only")):
+    """
+    Run every (asset_type, factor, mode) backtest in one DuckDB query.
+    Same selection rules as form_portfolios (ties broken by row order, like rank(method='first')).
+    frames / quantiles are keyed by asset_type; factors missing from a frame are skipped.
+    Returns:
+        holdings: selected rows (asset_type, factor, mode, date, ticker, position)
+        perf: daily portfolio_return and cumulative per strategy
+    """
+    con = duckdb.connect()
+    scores = []
+    for i, (asset, frame) in enumerate(frames.items()):
+        name = f"frame_{i}"
+        con.register(name, pa.Table.from_pandas(frame.assign(row_id=np.arange(len(frame))), preserve_index=False))
+        for factor in factors:
+            if factor not in frame.columns:
+                continue
+            scores.append(
+                f"""SELECT asset_type, date, ticker, "return", row_id, '{factor}' AS factor,
+                       "{factor}" AS score, {float(quantiles[asset])} AS quantile
+                    FROM {name} WHERE "{factor}" IS NOT NULL AND "return" IS NOT NULL"""
+            )
+    mode_values = ", ".join(f"('{mode}')" for mode in modes)
+
+    con.execute(f"""
+        CREATE TEMP TABLE holdings AS
+        WITH scores AS ({" UNION ALL ".join(scores)}),
+        ranked AS (
+            SELECT *,
+                ROW_NUMBER() OVER (PARTITION BY asset_type, factor, date ORDER BY score DESC, row_id) AS top_rank,
+                ROW_NUMBER() OVER (PARTITION BY asset_type, factor, date ORDER BY score ASC, row_id) AS bottom_rank,
+                COUNT(*) OVER (PARTITION BY asset_type, factor, date) AS n
+            FROM scores
+        ),
+        sized AS (
+            SELECT *, GREATEST(1, FLOOR(n * quantile))::BIGINT AS cutoff FROM ranked WHERE n >= 5
+        )
+        SELECT s.asset_type, s.factor, m.mode, s.date, s.ticker, s."return",
+            -- legs can overlap on ties, in which case the positions net out (as in form_portfolios)
+            (CASE WHEN s.top_rank <= s.cutoff THEN 1.0 / s.cutoff ELSE 0.0 END)
+            + (CASE WHEN m.mode = 'long_short' AND s.bottom_rank <= s.cutoff THEN -1.0 / s.cutoff ELSE 0.0 END)
+            AS position
+        FROM sized s CROSS JOIN (VALUES {mode_values}) AS m(mode)
+        WHERE (s.top_rank <= s.cutoff OR (m.mode = 'long_short' AND s.bottom_rank <= s.cutoff))
+          AND (m.mode = 'long_only' OR 2 * s.cutoff <= s.n)
+    """)
+    perf = con.execute("""
+        SELECT asset_type, factor, mode, date, SUM("return" * position) AS portfolio_return
+        FROM holdings GROUP BY asset_type, factor, mode, date
+        ORDER BY asset_type, factor, mode, date
+    """).fetch_arrow_table().to_pandas()
+    # Compound per strategy with the same guard as compute_performance: SQL's LN
+    # raises on a -100% or worse day
+    r = perf["portfolio_return"].to_numpy(dtype=np.float64)
+    strategy = perf[["asset_type", "factor", "mode"]]
+    starts = np.flatnonzero(np.r_[True, (strategy.iloc[1:].to_numpy() != strategy.iloc[:-1].to_numpy()).any(axis=1)])
+    cumulative = np.empty_like(r)
+    for start, stop in zip(starts, np.r_[starts[1:], len(r)]):
+        cumulative[start:stop] = compound_returns(r[start:stop])
+    perf["cumulative"] = cumulative
+    holdings = con.execute("""
+        SELECT asset_type, factor, mode, date, ticker, position FROM holdings
+        ORDER BY asset_type, factor, mode, date, ticker
+    """).fetch_arrow_table().to_pandas()
+    con.close()
+
+    return holdings, perf
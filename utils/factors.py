@@ -7,29 +7,43 @@ import numpy as np
 # Factor Construction
 # =========================
 
+def _per_ticker(df: pd.DataFrame, col: str, func) -> np.ndarray:
+    """
+    Apply a column-wise function to every ticker's series of `col` at once.
+    The wide matrix has one column per ticker and one row per position in that
+    ticker's (date-sorted) history, so uneven histories keep their own offsets.
+    Expects df sorted by ticker, date; returns values aligned to df's rows.
+    """
+    assert df["ticker"].is_monotonic_increasing, "factor inputs must be sorted by ticker, date"
+    # Sorted tickers -> integer codes; a row's position is its offset from the ticker's first row
+    cols, tickers = pd.factorize(df["ticker"])
+    starts = np.flatnonzero(np.r_[True, cols[1:] != cols[:-1]])
+    rows = np.arange(len(cols)) - starts[cols]
+    wide = np.full((rows.max(initial=-1) + 1, len(tickers)), np.nan)
+    wide[rows, cols] = df[col].to_numpy(dtype=np.float64)
+    return func(pd.DataFrame(wide, columns=tickers)).to_numpy()[rows, cols]
+
+
 def compute_returns(df: pd.DataFrame) -> pd.DataFrame:
-    """Add daily percent change returns per asset."""
-    df = df.sort_values(["ticker", "date"])
-    df["return"] = df.groupby("ticker")["close"].pct_change()
+    """Add daily percent change returns per asset (df sorted by ticker, date)."""
+    df["return"] = _per_ticker(df, "close", lambda close: close.pct_change(fill_method=None))
     return df
 
 
 def momentum_factor(df: pd.DataFrame, long_window=252, short_window=21) -> pd.DataFrame:
     """Momentum = past 12-month return minus last 1-month return."""
-    df = df.sort_values(["ticker", "date"])
-    df["momentum"] = (
-        df.groupby("ticker")["close"].transform(lambda x: x.pct_change(long_window))
-        - df.groupby("ticker")["close"].transform(lambda x: x.pct_change(short_window))
+    # (c/c_long - 1) - (c/c_short - 1) from two shifts; the -1 terms cancel
+    df["momentum"] = _per_ticker(
+        df, "close", lambda close: close / close.shift(long_window) - close / close.shift(short_window)
     )
     return df
 
 
 def volatility_factor(df: pd.DataFrame, window=30) -> pd.DataFrame:
     """Volatility = rolling std of daily returns."""
-    df = df.sort_values(["ticker", "date"])
     if "return" not in df.columns:
         df = compute_returns(df)
-    df["volatility"] = df.groupby("ticker")["return"].transform(lambda x: x.rolling(window).std())
+    df["volatility"] = _per_ticker(df, "return", lambda ret: ret.rolling(window).std())
     return df
 
 
@@ -42,16 +56,19 @@ def value_factor(df: pd.DataFrame) -> pd.DataFrame:
 
 def quality_factor(df: pd.DataFrame) -> pd.DataFrame:
     """Quality = synthetic proxy using smoothed returns."""
-    df = df.sort_values(["ticker", "date"])
-    df["quality"] = df.groupby("ticker")["return"].transform(lambda x: x.rolling(60).mean())
+    df["quality"] = _per_ticker(df, "return", lambda ret: ret.rolling(60).mean())
     return df
 
 
 def standardize_factors(df: pd.DataFrame, cols: list) -> pd.DataFrame:
     """Winsorize and z-score factors."""
-    for col in cols:
-        df[col] = df[col].clip(df[col].quantile(0.05), df[col].quantile(0.95))
-        df[col] = (df[col] - df[col].mean()) / df[col].std()
+    # All columns at once on one float matrix (NaNs are skipped, as pandas would)
+    values = df[cols].to_numpy(dtype=np.float64)
+    lo, hi = np.nanpercentile(values, [5, 95], axis=0)
+    np.clip(values, lo, hi, out=values)
+    values -= np.nanmean(values, axis=0)
+    values /= np.nanstd(values, axis=0, ddof=1)
+    df[cols] = values
     return df
 
 
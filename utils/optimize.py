@@ -4,9 +4,13 @@ import numpy as np
 from pypfopt.efficient_frontier import EfficientFrontier
 from pypfopt import risk_models, expected_returns
 
-def optimize_portfolio(returns: pd.DataFrame, constraint_crypto=0.2, method='max_sharpe'):
+def compute_moments(returns: pd.DataFrame):
     """
-    Optimize portfolio using mean-variance optimization with robust handling.
+    Clean returns and estimate the optimizer inputs.
+    Returns:
+        returns: Cleaned daily returns
+        mu: Annualized expected returns
+        S: Annualized, regularized covariance matrix
     """
     # Ensure no infinities or NaNs
     returns = returns.replace([np.inf, -np.inf], np.nan).dropna()
@@ -48,6 +52,16 @@ def optimize_portfolio(returns: pd.DataFrame, constraint_crypto=0.2, method='max
     # Convert back to DataFrame
     S = pd.DataFrame(S, index=returns.columns, columns=returns.columns)
     
+    return returns, mu, S
+
+def optimize_portfolio(returns: pd.DataFrame, constraint_crypto=0.2, method='max_sharpe', moments=None):
+    """
+    Optimize portfolio using mean-variance optimization with robust handling.
+    `moments` can carry a precomputed compute_moments(returns) result so that
+    switching methods only re-runs the solver.
+    """
+    returns, mu, S = moments if moments is not None else compute_moments(returns)
+    
     # Try optimization with different solvers
     solvers_to_try = ['ECOS', 'SCS', 'OSQP']
     
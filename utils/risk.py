@@ -1,40 +1,405 @@
 # utils/risk.py
+import math
+import os
 import pandas as pd
 import numpy as np
+from collections import deque
+from functools import cached_property
+from scipy.linalg import LinAlgError, cholesky
+from scipy.linalg.blas import get_blas_funcs
+from threadpoolctl import ThreadpoolController
 
-def compute_covariance_matrix(returns: pd.DataFrame):
+# One controller for the process: building it scans the loaded BLAS libraries (~0.3 ms),
+# after which each limit() switch is cheap
+_THREADPOOLS = ThreadpoolController()
+
+def _blas_limits(n_assets: int):
+    """
+    BLAS thread budget sized to the matrix: single-threaded below 128 assets (thread start-up
+    outweighs the work, and it nests badly inside already-parallel callers), at most 8 above.
+    """
+    n_threads = 1 if n_assets < 128 else min(8, os.cpu_count() or 1)
+    return _THREADPOOLS.limit(limits=n_threads, user_api="blas")
+
+def _dense_cov(X: np.ndarray):
+    """
+    Sample covariance as one BLAS rank-k update over the demeaned matrix.
+    X must be NaN-free with at least 2 rows (checked by the caller).
+    """
+    Xc = np.asfortranarray(X - X.mean(axis=0))
+    # Xc.T @ Xc is symmetric: SYRK computes only the upper triangle (half the FLOPs of GEMM);
+    # ssyrk/dsyrk is picked from the dtype
+    syrk = get_blas_funcs("syrk", (Xc,))
+    cov = syrk(alpha=1.0 / (len(X) - 1), a=Xc, trans=1, lower=0)
+    cov += np.triu(cov, 1).T
+    return cov
+
+def _array_module(backend: str):
+    """
+    Array namespace for `backend`: "numpy", or "cupy" / "jax" for GPU offload on very large
+    universes. The GPU libraries are optional and only imported when asked for.
+    """
+    if backend == "numpy":
+        return np
+    if backend == "cupy":
+        import cupy
+        return cupy
+    if backend == "jax":
+        import jax.numpy
+        return jax.numpy
+    raise ValueError(f"Unknown backend {backend!r}; expected 'numpy', 'cupy' or 'jax'")
+
+def _to_host(a):
+    """Device array -> NumPy (cupy arrays need an explicit copy back)."""
+    return a.get() if hasattr(a, "get") and not isinstance(a, np.ndarray) else np.asarray(a)
+
+def _device_cov(X: np.ndarray, xp):
+    """
+    Sample covariance on the `xp` device: demean, then one Xc.T @ Xc GEMM.
+    Same input contract as _dense_cov. Note that jax computes in float32 unless
+    jax_enable_x64 is set.
+    """
+    Xd = xp.asarray(X)
+    Xc = Xd - Xd.mean(axis=0)
+    return _to_host((Xc.T @ Xc) / (len(X) - 1))
+
+def _pairwise_sums(X: np.ndarray, squares: bool = False, cols=None):
+    """
+    Masked-GEMM building blocks for pairwise-complete statistics (pandas' NaN semantics).
+    For each pair only rows where both assets have data count: with M the validity mask and
+    X0 the (column-centred) data zeroed at NaNs,
+        N = M.T @ M,  S = X0.T @ M,  cross = X0.T @ X0 - S * S.T / N
+    and, with squares=True, each asset's own centred sum of squares over those rows,
+        ssq = (X0 * X0).T @ M - S * S / N
+    `cols` restricts the left factor to those columns, giving the (len(cols), k) rows of
+    N and cross only (not with squares).
+    """
+    valid = ~np.isnan(X)
+    M = valid.astype(X.dtype)
+    X0 = np.where(valid, X, 0).astype(X.dtype)
+    # Centring first keeps the raw-moment formula well conditioned; it doesn't change the result
+    counts = M.sum(axis=0)
+    X0 -= np.divide(X0.sum(axis=0), counts, out=np.zeros_like(counts), where=counts > 0)
+    X0 *= M
+    Xl, Ml = (X0, M) if cols is None else (X0[:, cols], M[:, cols])
+    N = Ml.T @ M
+    S = Xl.T @ M  # S[i, j]: sum of x_i over the rows shared with j
+    T = S.T if cols is None else Ml.T @ X0  # T[i, j]: sum of x_j over the rows shared with i
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cross = Xl.T @ X0 - S * T / N
+        ssq = (X0 * X0).T @ M - S * S / N if squares else None
+    return N, cross, ssq
+
+def _pairwise_cov(X: np.ndarray, cols=None):
+    """
+    Pairwise-complete sample covariance from masked GEMMs (see _pairwise_sums);
+    with `cols`, just those columns' rows of it.
+    """
+    N, cross, _ = _pairwise_sums(X, cols=cols)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = cross / (N - 1)
+    cov[N < 2] = np.nan
+    return cov
+
+def _pairwise_corr(X: np.ndarray):
+    """
+    Pairwise-complete correlation: each pair is scaled by the stds over its shared rows.
+    """
+    N, cross, ssq = _pairwise_sums(X, squares=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = cross / np.sqrt(ssq * ssq.T)
+    corr[N < 2] = np.nan
+    return corr
+
+def compute_covariance_matrix_np(X: np.ndarray, dtype=np.float64, backend: str = "numpy"):
+    """
+    Covariance of a (n_obs, k) returns array, ndarray in and out (no pandas boxing).
+    dtype=np.float32 halves the memory traffic for large universes.
+    backend="cupy" / "jax" runs the dense product on the GPU (NaN data stays on the CPU path).
+    """
+    X = np.asarray(X, dtype=dtype)
+    # One NaN scan up front: clean data never touches the masked pairwise machinery
+    nan_cols = np.isnan(X).any(axis=0)
+    with _blas_limits(X.shape[1]):
+        if len(X) < 2:
+            return _pairwise_cov(X)
+        if not nan_cols.any():
+            return _dense_cov(X) if backend == "numpy" else _device_cov(X, _array_module(backend))
+        # Pairs of complete columns share every row, so their block is the plain dense
+        # covariance; only the rows/columns of assets with gaps need masked GEMMs
+        dirty = np.flatnonzero(nan_cols)
+        clean = np.flatnonzero(~nan_cols)
+        cov = np.empty((X.shape[1], X.shape[1]), dtype=X.dtype)
+        block = _pairwise_cov(X, dirty)
+        cov[dirty, :] = block
+        cov[:, dirty] = block.T
+        if len(clean):
+            cov[np.ix_(clean, clean)] = _dense_cov(X[:, clean])
+    return cov
+
+def compute_covariance_matrix(returns: pd.DataFrame, dtype=np.float64, backend: str = "numpy"):
     """
     Compute covariance matrix of asset returns.
+    Labelled wrapper around compute_covariance_matrix_np.
     """
-    return returns.cov()
+    cov = compute_covariance_matrix_np(returns.to_numpy(dtype=dtype), dtype, backend)
+    return pd.DataFrame(cov, index=returns.columns, columns=returns.columns)
+
+def compute_correlation_matrix_np(X: np.ndarray):
+    """
+    Correlation of a (n_obs, k) returns array, ndarray in and out.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    with _blas_limits(X.shape[1]):
+        if len(X) >= 2 and not np.isnan(X).any():
+            with np.errstate(divide="ignore", invalid="ignore"):  # constant columns -> NaN, as in pandas
+                corr = np.corrcoef(X, rowvar=False)
+            np.fill_diagonal(corr, np.where(np.isnan(np.diag(corr)), np.nan, 1.0))
+        else:
+            corr = _pairwise_corr(X)
+    return corr
 
 def compute_correlation_matrix(returns: pd.DataFrame):
     """
     Compute correlation matrix between assets.
     """
-    return returns.corr()
+    corr = compute_correlation_matrix_np(returns.to_numpy(dtype=np.float64))
+    return pd.DataFrame(corr, index=returns.columns, columns=returns.columns)
+
+class RiskModel:
+    """
+    Covariance of a returns window, prepared once for repeated risk calls with different weights.
+    Holds a column-major (Fortran) array, BLAS's native layout and what the covariance
+    DataFrame already stores, so marginal_contribution_to_risk / risk_contribution skip the per-call coercion.
+    """
+    def __init__(self, returns: pd.DataFrame, dtype=np.float64):
+        self.tickers = list(returns.columns)
+        cov = compute_covariance_matrix_np(returns.to_numpy(dtype=dtype), dtype)
+        # Symmetric, so a C-ordered result's transpose is the same matrix in column-major layout
+        self.cov = cov if cov.flags.f_contiguous else cov.T
+
+    @cached_property
+    def cholesky(self):
+        """Lower Cholesky factor L (cov = L @ L.T), or None if cov isn't positive definite."""
+        try:
+            return cholesky(self.cov, lower=True, check_finite=False)
+        except LinAlgError:
+            return None
+
+    @cached_property
+    def row_sums(self):
+        """Σ @ 1: with equal weights w, Σw is just row_sums * w[0] (a reduction, no GEMV)."""
+        return self.cov.sum(axis=1)
+
+    def volatility(self, weights: np.ndarray):
+        """
+        Portfolio volatility sqrt(w.T Σ w) = ||L.T @ w||: one triangular matvec (half a GEMV)
+        once the factor is cached; falls back to the plain quadratic form.
+        """
+        weights = np.asarray(weights, dtype=self.cov.dtype)
+        L = self.cholesky
+        if L is None:
+            return weights.dot(self.cov.dot(weights)) ** 0.5
+        Lw = get_blas_funcs("trmv", (L,))(L, weights, lower=1, trans=1)
+        return Lw.dot(Lw) ** 0.5
+
+class RollingCov:
+    """
+    Sliding-window sample covariance kept up to date row by row (Welford updates).
+    Each new row adds, and each row leaving the window removes, a rank-1 term of
+    M2 = Σ (x-μ)(x-μ).T: O(k²) per day instead of recomputing the O(n·k²) window product.
+    Rows must be NaN-free.
+    """
+    def __init__(self, window: int):
+        self.window = window
+        self.n = 0
+        self.mean = None
+        self.M2 = None
+        self._rows = deque()
+        self._ger = None
+
+    def _rank1(self, alpha: float, x: np.ndarray, y: np.ndarray):
+        # M2 += alpha * x y.T, in place on the column-major buffer
+        self.M2 = self._ger(alpha, x, y, a=self.M2, overwrite_a=1)
 
-def marginal_contribution_to_risk(weights: np.ndarray, cov_matrix: np.ndarray):
+    def update(self, x_new: np.ndarray, x_old: np.ndarray | None = None):
+        """
+        Add x_new and drop x_old. Without x_old the window is tracked here: once full,
+        the oldest row held drops out.
+        """
+        # A copy: the row is held for later eviction, and streaming callers often refill one buffer
+        x_new = np.array(x_new, dtype=np.float64)
+        if self.mean is None:
+            k = len(x_new)
+            self.mean = np.zeros(k)
+            self.M2 = np.zeros((k, k), order="F")
+            self._ger = get_blas_funcs("ger", (self.M2,))
+        if x_old is None:
+            if len(self._rows) == self.window:
+                x_old = self._rows.popleft()
+            self._rows.append(x_new)
+        else:
+            x_old = np.asarray(x_old, dtype=np.float64)
+        if x_old is not None:
+            # Reverse Welford step: μ' = μ - (x-μ)/(n-1),  M2' = M2 - (x-μ)(x-μ').T
+            self.n -= 1
+            d = x_old - self.mean
+            if self.n:
+                self.mean -= d / self.n
+            else:
+                self.mean[:] = 0.0
+            self._rank1(-1.0, d, x_old - self.mean)
+        # Welford step: μ' = μ + (x-μ)/n,  M2' = M2 + (x-μ)(x-μ').T
+        self.n += 1
+        d = x_new - self.mean
+        self.mean += d / self.n
+        self._rank1(1.0, d, x_new - self.mean)
+
+    @property
+    def cov(self):
+        """Current window's sample covariance (NaN with fewer than 2 rows)."""
+        if self.n < 2:
+            return np.full_like(self.M2, np.nan) if self.M2 is not None else None
+        return self.M2 / (self.n - 1)
+
+def _cov_array(cov_matrix, dtype=None):
+    """
+    The covariance as a BLAS-ready float ndarray (from an array, a DataFrame or a RiskModel).
+    dtype defaults to the covariance's float dtype (float64 otherwise).
+    """
+    if isinstance(cov_matrix, RiskModel):
+        cov_matrix = cov_matrix.cov
+    # For small k the O(k²) work is tiny and per-call overhead dominates, so a
+    # ready-to-use array (e.g. a RiskModel's) skips every conversion. Either contiguous
+    # layout goes to BLAS as-is (row- vs column-major is just its transpose flag), so the
+    # column-major arrays pandas hands out are not copied on every call
+    if isinstance(cov_matrix, pd.DataFrame):
+        cov_matrix = cov_matrix.to_numpy()
+    ready = (
+        type(cov_matrix) is np.ndarray
+        and cov_matrix.dtype.char in "fd"  # float32 / float64
+        and (cov_matrix.flags.c_contiguous or cov_matrix.flags.f_contiguous)
+        and (dtype is None or cov_matrix.dtype == dtype)
+    )
+    if not ready:
+        if dtype is None:
+            dtype = np.float32 if np.asarray(cov_matrix).dtype == np.float32 else np.float64
+        cov_matrix = np.asfortranarray(cov_matrix, dtype=dtype)
+    return cov_matrix
+
+def _mctr_core(weights: np.ndarray, cov_matrix, dtype=None):
+    """
+    MCTR and the portfolio variance (a plain float); the sqrt is left to callers that need it.
+    """
+    model = cov_matrix if isinstance(cov_matrix, RiskModel) else None
+    cov_matrix = _cov_array(cov_matrix, dtype)
+    weights = np.asarray(weights, dtype=cov_matrix.dtype)
+    if model is not None and cov_matrix is model.cov and weights.min() == weights.max():
+        sigma_w = model.row_sums * weights[0]  # equal-weight baseline: cached Σ @ 1
+    else:
+        # The only O(k²) product, reused for the variance: w.T Σ w as w @ (Σ @ w) is a GEMV
+        # plus a dot, both BLAS. Don't rewrite it as einsum("i,ij,j->", w, S, w): einsum's
+        # own loop is single-threaded and far slower at large k
+        sigma_w = cov_matrix.dot(weights)
+    portfolio_var = float(weights.dot(sigma_w))
+    mctr = weights * sigma_w
+    mctr /= portfolio_var
+    return mctr, portfolio_var
+
+def marginal_contribution_to_risk(weights: np.ndarray, cov_matrix, dtype=None):
     """
     Compute Marginal Contribution to Total Risk (MCTR)
     MCTR_i = w_i * (Σ * w)_i / (w.T * Σ * w)
+    cov_matrix can be an array, a DataFrame or a RiskModel.
+    dtype defaults to the covariance's float dtype (float64 otherwise).
     """
-    portfolio_var = weights.T @ cov_matrix @ weights
-    portfolio_vol = np.sqrt(portfolio_var)
-    mctr = (weights * (cov_matrix @ weights)) / portfolio_var
+    mctr, portfolio_var = _mctr_core(weights, cov_matrix, dtype)
+    # A non-PSD (pairwise) covariance can give a negative variance: NaN vol, as before
+    portfolio_vol = math.sqrt(portfolio_var) if portfolio_var >= 0 else math.nan
     return mctr, portfolio_vol
 
-def risk_contribution(weights: np.ndarray, cov_matrix: np.ndarray, tickers=None):
+def marginal_contribution_to_risk_batched(weights: np.ndarray, cov_matrix, dtype=None, backend: str = "numpy"):
+    """
+    MCTR for N portfolios at once: weights is (k, N), one weight vector per column.
+    A single Σ @ W (GEMM) reads Σ once for all N instead of N separate matvecs.
+    Returns (mctr (k, N), portfolio_vol (N,)).
+    backend="cupy" / "jax" runs it on the GPU; results come back as NumPy arrays.
+    """
+    cov_matrix = _cov_array(cov_matrix, dtype)
+    weights = np.asarray(weights, dtype=cov_matrix.dtype)
+    if weights.ndim == 1:
+        weights = weights[:, None]
+    if backend != "numpy":
+        xp = _array_module(backend)
+        mctr, portfolio_vol = _mctr_batched_core(xp.asarray(weights), xp.asarray(cov_matrix), xp)
+        return _to_host(mctr), _to_host(portfolio_vol)
+    with _blas_limits(cov_matrix.shape[0]):
+        return _mctr_batched_core(weights, cov_matrix)
+
+def _mctr_batched_core(weights, cov_matrix, xp=np):
+    """
+    Array-API body of the batched MCTR (no in-place ops, so jax arrays work too).
+    Σ @ W stays a matmul (GEMM); einsum("ij,jb->ib", ...) would skip the threaded BLAS.
+    """
+    mctr = weights * (cov_matrix @ weights)
+    portfolio_var = mctr.sum(axis=0)
+    # A non-PSD (pairwise) covariance can give a negative variance: quiet NaN vol, as in
+    # marginal_contribution_to_risk
+    portfolio_vol = xp.where(portfolio_var >= 0, portfolio_var, xp.nan) ** 0.5
+    return mctr / portfolio_var, portfolio_vol
+
+def risk_contribution_fast(weights: np.ndarray, cov_matrix, out: np.ndarray | None = None):
+    """
+    Array-only risk contributions for inner loops (e.g. optimizer callbacks).
+    Returns (mctr, pct_contrib) as plain ndarrays; pass `out` to write pct_contrib in place.
+    """
+    mctr, _ = _mctr_core(weights, cov_matrix)
+    pct_contrib = np.divide(mctr, mctr.sum(), out=out)
+    return mctr, pct_contrib
+
+def risk_contribution(weights: np.ndarray, cov_matrix, tickers=None):
     """
     Compute percentage risk contributions.
+    With a RiskModel, its tickers label the result unless `tickers` is given.
     """
-    mctr, vol = marginal_contribution_to_risk(weights, cov_matrix)
-    pct_contrib = mctr / mctr.sum()
+    if tickers is None and isinstance(cov_matrix, RiskModel):
+        tickers = cov_matrix.tickers
+    _, pct_contrib = risk_contribution_fast(weights, cov_matrix)
     if tickers is not None:
+        # Ready-made arrays with copy=False: no per-column inference or copies into new blocks.
+        # Weights are the one input copied, so the frame never aliases the caller's array
         return pd.DataFrame({
-            "Asset": tickers,
-            "Weight": weights,
+            "Asset": np.asarray(tickers, dtype=object),
+            "Weight": np.array(weights, dtype=np.float64),
             "Risk Contribution": pct_contrib
-        })
+        }, copy=False)
     else:
         return pct_contrib
+
+def rolling_sharpe(returns: np.ndarray, window: int = 60):
+    """
+    Rolling (non-annualized) Sharpe ratio: rolling mean / rolling sample std.
+    Both window moments come from one cumulative-sum pass over the series,
+    shifted by the full-sample mean to keep the running sums well conditioned.
+    As with pandas' rolling, any window containing a NaN gives NaN.
+    """
+    x = np.asarray(returns, dtype=np.float64)
+    out = np.full(x.shape, np.nan)
+    if len(x) < window:
+        return out
+
+    missing = np.isnan(x)
+    shift = x[~missing].mean() if not missing.all() else 0.0
+    xc = np.where(missing, 0.0, x - shift)
+    c1 = np.concatenate(([0.0], np.cumsum(xc)))
+    c2 = np.concatenate(([0.0], np.cumsum(xc * xc)))
+    cn = np.concatenate(([0], np.cumsum(missing)))
+    s1 = c1[window:] - c1[:-window]
+    s2 = c2[window:] - c2[:-window]
+
+    mean_c = s1 / window
+    var = np.maximum(s2 - s1 * mean_c, 0.0) / (window - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sharpe = (mean_c + shift) / np.sqrt(var)
+    out[window - 1:] = np.where(cn[window:] - cn[:-window] > 0, np.nan, sharpe)
+    return out